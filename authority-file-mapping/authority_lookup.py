@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Indexed lookup store over the final authority mapping (ordered_khi_a30gn_data.csv).
+Every identifier of every KHI record is stored in an SQLite table indexed by identifier type and value,
+so that other tools can answer "which KHI record has GND X" or "which Wikidata entity does a record map to"
+without loading the whole csv file. The store is updated by each run of the mapping script.
+
+Usage:
+    python authority_lookup.py lookup gnd 118540238
+    python authority_lookup.py lookup key_khi oai_kue_0700001.xml
+    python authority_lookup.py benchmark --lookups 10000
+'''
+
+
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import time
+
+
+DEFAULT_STORE = "khi_authority_lookup.sqlite"
+IDENTIFIER_TYPES = ("key_khi", "gnd", "ulan", "viaf", "wd")
+
+
+def connect_store(store_path=DEFAULT_STORE):
+    '''
+    Opens the lookup store, creating its table and indexes if needed.
+    '''
+    conn = sqlite3.connect(store_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS identifiers (
+            id_type TEXT NOT NULL,
+            value TEXT NOT NULL,
+            key_khi TEXT NOT NULL,
+            PRIMARY KEY (id_type, value, key_khi)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS identifiers_key_khi ON identifiers (key_khi, id_type)')
+    return conn
+
+
+def normalize_identifier(id_type, value):
+    '''
+    Returns the identifier as stored: without its "gnd:"-like prefix and, for Wikidata, as the bare QID
+    (wd:Q42 and http://www.wikidata.org/entity/Q42 both become Q42).
+    '''
+    value = str(value).strip()
+    if value.startswith(f"{id_type}:"):
+        value = value[len(id_type) + 1:]
+    if id_type == 'wd':
+        value = value.rstrip('/').split('/')[-1]
+    return value.strip()
+
+
+def update_lookup_store(mapping_csv, store_path=DEFAULT_STORE, batch_size=10000):
+    '''
+    Adds the records of a mapping csv file to the lookup store. Records already in the store are replaced
+    by their new identifiers, records missing from the csv file are kept, so each run updates the store
+    incrementally. The csv file is read in batches of batch_size records. Returns the number of records.
+    '''
+    conn = connect_store(store_path)
+    record_count = 0
+    try:
+        with open(mapping_csv, 'r', newline='') as f_in:
+            reader = csv.DictReader(f_in)
+            id_columns = [col for col in reader.fieldnames if col != 'key_khi']
+            batch = []
+
+            for row in reader:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    _replace_records(conn, batch, id_columns)
+                    record_count += len(batch)
+                    batch = []
+            if batch:
+                _replace_records(conn, batch, id_columns)
+                record_count += len(batch)
+
+        conn.commit()
+    finally:
+        conn.close()
+    return record_count
+
+
+def _replace_records(conn, rows, id_columns):
+    # Identifiers are stored one per row; multiple values of a column are separated by "; "
+    entries = []
+    for row in rows:
+        for col in id_columns:
+            if row[col]:
+                for value in row[col].split("; "):
+                    value = normalize_identifier(col, value)
+                    if value:
+                        entries.append((col, value, row['key_khi']))
+
+    conn.executemany('DELETE FROM identifiers WHERE key_khi = ?', [(row['key_khi'],) for row in rows])
+    conn.executemany('INSERT OR IGNORE INTO identifiers (id_type, value, key_khi) VALUES (?, ?, ?)', entries)
+
+
+class AuthorityLookup:
+    '''
+    Read-only query API over the lookup store.
+
+        with AuthorityLookup() as lookup:
+            lookup.find_records('gnd', '118540238')   # ['oai_kue_0700001.xml']
+            lookup.identifiers('oai_kue_0700001.xml')  # {'gnd': ['118540238'], 'wd': ['Q42']}
+            lookup.lookup('viaf', '12345')             # {'oai_kue_0700001.xml': {...}}
+    '''
+    def __init__(self, store_path=DEFAULT_STORE):
+        if not os.path.exists(store_path):
+            raise FileNotFoundError(f"Lookup store at '{store_path}' not found. Please run the mapping script first.")
+        self.conn = sqlite3.connect(f"file:{store_path}?mode=ro", uri=True)
+
+    def find_records(self, id_type, value):
+        '''
+        Returns the KHI records that have the given identifier, e.g. find_records('wd', 'Q42').
+        '''
+        if id_type == 'key_khi':
+            exists = self.conn.execute('SELECT 1 FROM identifiers WHERE key_khi = ? LIMIT 1', (value,)).fetchone()
+            return [value] if exists else []
+        rows = self.conn.execute('SELECT key_khi FROM identifiers WHERE id_type = ? AND value = ? ORDER BY key_khi',
+                                 (id_type, normalize_identifier(id_type, value)))
+        return [key_khi for (key_khi,) in rows]
+
+    def identifiers(self, key_khi):
+        '''
+        Returns all identifiers of a KHI record by type, e.g. {'gnd': ['118540238'], 'wd': ['Q42']}.
+        '''
+        result = {}
+        rows = self.conn.execute('SELECT id_type, value FROM identifiers WHERE key_khi = ? ORDER BY id_type, value',
+                                 (key_khi,))
+        for id_type, value in rows:
+            result.setdefault(id_type, []).append(value)
+        return result
+
+    def lookup(self, id_type, value):
+        '''
+        Returns the identifiers of every KHI record that has the given identifier, by record.
+        '''
+        return {key_khi: self.identifiers(key_khi) for key_khi in self.find_records(id_type, value)}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark_lookups(store_path=DEFAULT_STORE, lookups=10000, seed=0):
+    '''
+    Measures the latency of find_records and identifiers on identifiers sampled from the store
+    and prints the median, 99th percentile and maximum in microseconds.
+    '''
+    with AuthorityLookup(store_path) as lookup:
+        sample = lookup.conn.execute('SELECT id_type, value, key_khi FROM identifiers ORDER BY random() LIMIT ?',
+                                     (lookups,)).fetchall()
+        if not sample:
+            print("The lookup store is empty.")
+            return
+        rng = random.Random(seed)
+        queries = [rng.choice(sample) for _ in range(lookups)]
+
+        for name, run in (("find_records", lambda q: lookup.find_records(q[0], q[1])),
+                          ("identifiers", lambda q: lookup.identifiers(q[2]))):
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                run(query)
+                latencies.append((time.perf_counter() - start) * 1e6)
+            latencies.sort()
+            print(f"{name}: {len(latencies)} lookups, median {latencies[len(latencies) // 2]:.1f} us, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)]:.1f} us, max {latencies[-1]:.1f} us")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the indexed lookup store of the authority mapping")
+    parser.add_argument('--store', type=str, default=DEFAULT_STORE, help='Path to the lookup store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    lookup_parser = subparsers.add_parser('lookup', help='Find the KHI records with an identifier')
+    lookup_parser.add_argument('id_type', choices=IDENTIFIER_TYPES, help='Identifier type')
+    lookup_parser.add_argument('value', type=str, help='Identifier, e.g. 118540238, Q42 or oai_kue_0700001.xml')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Measure the lookup latency')
+    benchmark_parser.add_argument('--lookups', type=int, default=10000, help='Number of lookups to run')
+
+    args = parser.parse_args()
+
+    if args.command == 'lookup':
+        with AuthorityLookup(args.store) as authority_lookup:
+            for key_khi, identifiers in authority_lookup.lookup(args.id_type, args.value).items():
+                joined = "; ".join(f"{id_type}:{value}" for id_type, values in identifiers.items() for value in values)
+                print(f"{key_khi},{joined}")
+    else:
+        benchmark_lookups(args.store, args.lookups)
@@ -9,10 +9,18 @@ import argparse
 import pandas as pd
 import datetime
 import re
+import sys
+import sqlite3
+import tempfile
 from collections import defaultdict
 from SPARQLWrapper import SPARQLWrapper, JSON, CSV, XML
 import requests
 import numpy as np  
+from authority_lookup import DEFAULT_STORE, update_lookup_store
+
+# instrumentation.py is shared by both scripts and lives in the root folder of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Metrics, ProgressReporter
 
 
 
@@ -24,8 +32,12 @@ prefixes_dict = {"gnd": "gnd", "ulan": "ulan", "viaf":"viaf"}
 USER_AGENT = "mapping_khi_authority_data/1.0 (alessandra.failla@khi.fi.it) Python/3.10"
 
 
+metrics = Metrics("khi_mapping")
+
+
 
 #STEP 1
+@metrics.profiled
 def extract_a30gn(xml_content):
     '''
     Extracts content from the xml <a30gn> element, which includes authority data, and returns it.
@@ -57,9 +69,10 @@ def extract_authority_data(folder_path):
     output_initial_extraction = f"khi_a30gn_data.txt"
 
     # Open the output file in append mode, count of total documents processed and times content was extracted
-    with open(output_initial_extraction, 'a', newline='') as f_out:
+    with open(output_initial_extraction, 'a', newline='') as f_out, metrics.stage("extract"):
         total_documents = 0
         extracted_count = 0
+        progress = ProgressReporter("Documents inspected")
 
         # Iterate over all XML files in the folder
         for file_name in os.listdir(folder_path):
@@ -77,11 +90,14 @@ def extract_authority_data(folder_path):
                             extracted_count += 1  # Increment count of extracted content
 
                 except Exception as e:
+                    metrics.inc("extract_errors_total")
                     print(f"Error processing file {file_name}: {e}")
 
                 total_documents += 1
-                if total_documents % 500 == 0:
-                    print(f"Documents inspected: {total_documents}, Content extracted: {extracted_count}")
+                progress.update(extracted=extracted_count)
+
+        metrics.inc("documents_inspected_total", total_documents)
+        metrics.inc("authority_records_extracted_total", extracted_count)
 
         # Print final counts after processing all documents
         print(f"Total documents inspected: {total_documents}, Total content extracted: {extracted_count}")
@@ -89,10 +105,12 @@ def extract_authority_data(folder_path):
 
 
 # AUXILIARY FUNCTIONS FOR SPARQL QUERIES IN STEP 2
-def build_sparql_query(prefix, values):
+def build_sparql_query(prefix, values, expand=False):
     '''
     Builds SPARQL query based on identifier. GNDs, ULANs, and VIAFs are mapped to Wikidata entities,
     then Wikidata entities are used to retrieve additional missing GNDs, ULANs, and VIAFs.
+    With expand, GND, ULAN, and VIAF queries also return all GNDs, ULANs, and VIAFs of the matched entities
+    (as ?wd_gnd, ?wd_ulan, ?wd_viaf), so these entities need no second query.
     '''
     # Common SELECT clause
     select_clause = f"""
@@ -128,6 +146,16 @@ def build_sparql_query(prefix, values):
     else:
         raise NotImplementedError(f"This prefix is not implemented: {prefix}")
 
+    if expand and prefix != 'wd':
+        select_clause = f"""
+    SELECT ?{prefix} ?wd ?wd_gnd ?wd_ulan ?wd_viaf WHERE {{
+    """
+        query_section += """
+            OPTIONAL { ?wd wdt:P227 ?wd_gnd. }
+            OPTIONAL { ?wd wdt:P245 ?wd_ulan. }
+            OPTIONAL { ?wd wdt:P214 ?wd_viaf. }
+        """
+
     # Complete query
     query = f"{select_clause} {values_clause} {query_section} }}"
 
@@ -142,22 +170,25 @@ def execute_sparql_query(endpoint, query):
     sparql.setQuery(query)
     sparql.setReturnFormat(JSON)
     sparql.addCustomHttpHeader("User-agent", USER_AGENT)
+    metrics.inc("sparql_queries_total")
     try:
-        results = sparql.query().convert()
+        with metrics.timed("sparql_query_seconds"):
+            results = sparql.query().convert()
         return results
     
     except Exception as e:
+        metrics.inc("sparql_failures_total")
         print(f"SPARQL query failed: {e}")
         return None
 
     
-def process_authority(prefix, values, WD_SPARQL_ENDPOINT):
+def process_authority(prefix, values, WD_SPARQL_ENDPOINT, expand=False):
     '''
     Builds a SPARQL query based on the provided prefix and values,
     then executes the query on the specified Wikidata SPARQL endpoint.
     Returns the query result.
     '''
-    query = build_sparql_query(prefix, values)
+    query = build_sparql_query(prefix, values, expand)
     if query is None:
         print("The query was not generated.")
         return None
@@ -232,15 +263,110 @@ def process_txt_to_pd(input_file):
     return df_khi
 
 
-def mapping_from_wikidata(output_df):
+@metrics.profiled
+def match_wd_bindings(prefix, batch, bindings, output_df):
+    '''
+    Matches the results of a forward query (gnd/ulan/viaf -> wd) with the values in the batch
+    and stores the Wikidata entity in output_df. Conflicting entities are written to the conflicts log.
+    '''
+    # Iterate over the batch to match results with the original DataFrame
+    for index, value in batch.items():
+        # Initialize a list to hold additional matches
+        matched_wd_values = []
+
+        for binding in bindings:
+            # Match the value with the query result
+            if binding[prefix]['value'] == value:
+                matched_wd_values.append(binding['wd']['value'])
+
+        # Update the output DataFrame
+        if matched_wd_values:
+            current_wd_value = output_df.at[index, "wd"]
+
+            if current_wd_value == "":
+                # Join matched values for "wd"
+                output_df.at[index, "wd"] = matched_wd_values[0]
+
+            elif output_df.at[index, 'wd'] != matched_wd_values[0]:
+                conflict_message = f"Wikidata conflict: {output_df.at[index, 'wd']},{matched_wd_values[0]}"
+                metrics.inc("wd_conflicts_total", prefix=prefix)
+                with open('wd_conflicts_log.txt', 'a') as log_file:
+                    log_file.write(conflict_message + '\n')
+
+
+@metrics.profiled
+def match_authority_bindings(batch, bindings, output_df):
+    '''
+    Matches the results of a reverse query (wd -> gnd/ulan/viaf) with the entities in the batch
+    and adds the retrieved identifiers to output_df.
+    '''
+    # Iterate over the batch to match results with the original DataFrame
+    for index, value in batch.items():
+        
+        for prefix in prefixes_dict:
+            matched_prefix_values = []
+            for binding in bindings:
+        
+                if binding['wd']['value'] == value and prefix in binding.keys():
+                    if binding[prefix]['value'] not in matched_prefix_values:
+                        matched_prefix_values.append(binding[prefix]['value'])
+
+            if len(matched_prefix_values) > 0:
+                current_prefix_value = output_df.at[index, prefix]
+                # Handle current_prefix_value safely
+                if pd.isna(current_prefix_value):
+                    current_prefix_value = ""
+                else:
+                    current_prefix_value = str(current_prefix_value)
+
+                total_matched = "; ".join(matched_prefix_values)
+                if current_prefix_value == "":
+                    output_df.at[index, prefix] = total_matched
+                elif total_matched != current_prefix_value:
+                    output_df.at[index, prefix] = current_prefix_value + "; " + total_matched
+
+
+def collect_expanded_entities(bindings, expanded_entities):
+    '''
+    Stores the GNDs, ULANs, and VIAFs returned by an expanded forward query for each entity not seen before,
+    in the format of the reverse query bindings, so that mapping_from_wikidata does not query these entities again.
+    '''
+    new_entities = {}
+    for binding in bindings:
+        wd = binding['wd']['value']
+        if wd in expanded_entities:
+            continue
+        reverse_binding = {'wd': binding['wd']}
+        for prefix in prefixes_dict:
+            if f'wd_{prefix}' in binding:
+                reverse_binding[prefix] = binding[f'wd_{prefix}']
+        new_entities.setdefault(wd, []).append(reverse_binding)
+    expanded_entities.update(new_entities)
+
+
+def mapping_from_wikidata(output_df, expanded_entities=None):
     '''
     Takes a dataframe as input containing originally available identifiers and their Wikidata mapping
     (if available). Uses Wikidata entities to retrieve missing ULANs, GNDs, VIAFs, if available on Wikidata.
+    Entities in expanded_entities are completed from the forward query results; only the others are queried.
     '''
     tmp_df = output_df['wd'].dropna()
     batch_size = 100
+
+    if expanded_entities is not None:
+        is_expanded = tmp_df.isin(list(expanded_entities))
+        cached_df = tmp_df[is_expanded]
+        for batch_index in range(0, len(cached_df), batch_size):
+            batch = cached_df.iloc[batch_index:batch_index + batch_size]
+            bindings = [binding for value in batch.unique() for binding in expanded_entities[value]]
+            match_authority_bindings(batch, bindings, output_df)
+        metrics.inc("wd_cache_hits_total", len(cached_df))
+        # Records without a Wikidata entity cannot match anything either
+        tmp_df = tmp_df[~is_expanded & (tmp_df != "")]
+
     num_batches = (len(tmp_df) + batch_size -1) // batch_size
     print(f"now executing wd")
+    progress = ProgressReporter("Batches processed (wd)", total=num_batches)
     for batch_index in range(num_batches):
             
             # batch = tmp_df.iloc[0:200]...[200:400]...
@@ -249,51 +375,27 @@ def mapping_from_wikidata(output_df):
             batch_values = batch.apply(lambda x: f'<{x}>').astype(str)
             col_to_string = ' '.join(batch_values)
 
-            print(f"Processing batch {batch_index + 1}/{num_batches}")
+            metrics.inc("sparql_batches_total", prefix="wd")
             query_result = process_authority('wd', col_to_string, WD_SPARQL_ENDPOINT)
+            progress.update()
 
             if query_result:
-                # Iterate over the batch to match results with the original DataFrame
-                for index, value in batch.items():
-                    
-                    for prefix in prefixes_dict:
-                        matched_prefix_values = []
-                        for binding in query_result['results']['bindings']:
-                    
-                            if binding['wd']['value'] == value and prefix in binding.keys():
-                                if binding[prefix]['value'] not in matched_prefix_values:
-                                    matched_prefix_values.append(binding[prefix]['value'])
-
-                        if len(matched_prefix_values) > 0:
-                            current_prefix_value = output_df.at[index, prefix]
-                            # Handle current_prefix_value safely
-                            if pd.isna(current_prefix_value):
-                                current_prefix_value = ""
-                            else:
-                                current_prefix_value = str(current_prefix_value)
-
-                            total_matched = "; ".join(matched_prefix_values)
-                            if current_prefix_value == "":
-                                output_df.at[index, prefix] = total_matched
-                            elif total_matched != current_prefix_value:
-                                output_df.at[index, prefix] = current_prefix_value + "; " + total_matched
+                match_authority_bindings(batch, query_result['results']['bindings'], output_df)
 
     output_df['wd'] = output_df['wd'].apply(lambda x: f"wd:{x.split('/')[-1]}" if x != "" else "")
     return output_df
     
 
 
-def process_and_map_data(folder_path, WD_SPARQL_ENDPOINT):
+def map_authority_dataframe(authority_df, WD_SPARQL_ENDPOINT, reuse_results=True):
     '''
-    Converts input text file into a DataFrame through the auxiliary function.
-    Isolated each column and create batches to extract values for the query avoiding errors.
-    Performs a query for batches in each column (gnd -> wd, ulan -> wd, viaf -> wd)
-
+    Maps the identifiers in authority_df to Wikidata entities (gnd -> wd, ulan -> wd, viaf -> wd),
+    completes them with the reverse mapping from Wikidata and prefixes every identifier with its authority file.
+    With reuse_results, the forward queries also return the identifiers of the matched entities, which
+    the reverse mapping reuses instead of querying the same entities again.
+    Returns the resulting DataFrame, empty columns included.
     '''
-    output_initial_extraction=extract_authority_data(folder_path)
-    ordered_csv_output = f"ordered_{output_initial_extraction[:-4]}.csv"
-    # Convert authority data into ordered csv file with columns sorted by authority file
-    authority_df = process_txt_to_pd(output_initial_extraction)
+    expanded_entities = {} if reuse_results else None
     output_df = authority_df.copy()
 
     # Initialize the new column to store query results
@@ -310,100 +412,376 @@ def process_and_map_data(folder_path, WD_SPARQL_ENDPOINT):
 
         batch_size = 200
         num_batches = (len(tmp_df) + batch_size -1) // batch_size
+        progress = ProgressReporter(f"Batches processed ({col})", total=num_batches)
 
-        for batch_index in range(num_batches):
-            # batch = tmp_df.iloc[0:200]...[200:400]...
-            batch = tmp_df.iloc[batch_index * batch_size:(batch_index+1) * batch_size]
+        with metrics.stage(f"forward_{col}"):
+            for batch_index in range(num_batches):
+                # batch = tmp_df.iloc[0:200]...[200:400]...
+                batch = tmp_df.iloc[batch_index * batch_size:(batch_index+1) * batch_size]
 
-            batch_values = batch.apply(lambda x: f'"{x}"').astype(str)
-            col_to_string = ' '.join(batch_values)
-
-            print(f"Processing batch {batch_index + 1}/{num_batches}")
+                batch_values = batch.apply(lambda x: f'"{x}"').astype(str)
+                col_to_string = ' '.join(batch_values)
 
-            query_result = process_authority(prefix, col_to_string, WD_SPARQL_ENDPOINT)
+                metrics.inc("sparql_batches_total", prefix=col)
+                query_result = process_authority(prefix, col_to_string, WD_SPARQL_ENDPOINT, expand=reuse_results)
+                progress.update()
 
-            if query_result:
-                # Iterate over the batch to match results with the original DataFrame
-                for index, value in batch.items():
-                    # Initialize a list to hold additional matches
-                    matched_wd_values = []
-
-                    for binding in query_result['results']['bindings']:
-                        # Match the value with the query result
-                        if binding[prefix]['value'] == value:
-                            matched_wd_values.append(binding['wd']['value'])
-
-                    # Update the output DataFrame
-                    if matched_wd_values:
-                        current_wd_value = output_df.at[index, "wd"]
-
-                        if current_wd_value == "":
-                            # Join matched values for "wd"
-                            output_df.at[index, "wd"] = matched_wd_values[0]
-
-                        elif output_df.at[index, 'wd'] != matched_wd_values[0]:
-                            conflict_message = f"Wikidata conflict: {output_df.at[index, 'wd']},{matched_wd_values[0]}"
-                            print(conflict_message)
-                            with open('wd_conflicts_log.txt', 'a') as log_file:
-                                log_file.write(conflict_message + '\n')
+                if query_result:
+                    match_wd_bindings(prefix, batch, query_result['results']['bindings'], output_df)
+                    if expanded_entities is not None:
+                        collect_expanded_entities(query_result['results']['bindings'], expanded_entities)
 
     # Complete data with reverse mapping from wikidata
-    output_df = mapping_from_wikidata(output_df)
-
-    # Remove empty columns
-    output_df.dropna(axis=1, how='all', inplace=True)
-    authority_df.dropna(axis=1, how='all', inplace=True)
+    with metrics.stage("reverse_wd"):
+        output_df = mapping_from_wikidata(output_df, expanded_entities)
 
     for col in output_df:
         if col in prefixes_dict.values():
             output_df[col] = output_df[col].apply(lambda x: "; ".join([f"{col}:{val.strip()}" for val in x.split("; ")]) if pd.notna(x) else x)
 
+    return output_df
+
+
+def process_and_map_data(folder_path, WD_SPARQL_ENDPOINT, reuse_results=True, lookup_store=DEFAULT_STORE):
+    '''
+    Converts input text file into a DataFrame through the auxiliary function.
+    Isolated each column and create batches to extract values for the query avoiding errors.
+    Performs a query for batches in each column (gnd -> wd, ulan -> wd, viaf -> wd)
+    The resulting mapping is also added to the indexed lookup store, unless lookup_store is None.
+
+    '''
+    output_initial_extraction=extract_authority_data(folder_path)
+    ordered_csv_output = f"ordered_{output_initial_extraction[:-4]}.csv"
+    # Convert authority data into ordered csv file with columns sorted by authority file
+    with metrics.stage("txt_to_dataframe"):
+        authority_df = process_txt_to_pd(output_initial_extraction)
+
+    output_df = map_authority_dataframe(authority_df, WD_SPARQL_ENDPOINT, reuse_results)
+
+    # Remove empty columns
+    output_df.dropna(axis=1, how='all', inplace=True)
 
     # Save the output DataFrame to CSV
-    output_df.to_csv(ordered_csv_output, index=False)
+    with metrics.stage("write_csv"):
+        output_df.to_csv(ordered_csv_output, index=False)
+    metrics.inc("bytes_written_total", os.path.getsize(ordered_csv_output), output="csv")
+    metrics.inc("mapped_records_total", len(output_df))
     print(f"Results saved to {ordered_csv_output}")
+
+    if lookup_store is not None:
+        write_lookup_store(ordered_csv_output, lookup_store)
     return output_df, ordered_csv_output
-        
 
-def extract_map_replace_xml(folder_path):
+
+def write_lookup_store(ordered_csv_output, lookup_store):
+    '''
+    Updates the indexed lookup store with the records of the ordered csv file.
+    '''
+    with metrics.stage("update_lookup_store"):
+        record_count = update_lookup_store(ordered_csv_output, lookup_store)
+    metrics.inc("lookup_store_records_total", record_count)
+    print(f"Lookup store {lookup_store} updated with {record_count} records")
+
+
+# STEP 2 (CHUNKED MODE)
+# Initial estimate of the resident memory needed per record of a partition, refined while mapping
+PARTITION_MB_PER_RECORD = 0.002
+
+
+def peak_rss_mb():
+    '''
+    Returns the peak resident memory of the process in MB.
+    '''
+    import resource
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    '''
+    Returns the resident memory of the process in MB. Where /proc is not available, the peak resident memory
+    is returned instead, which is an upper bound of it.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def load_txt_to_store(input_file, conn):
+    '''
+    Streaming counterpart of process_txt_to_pd: loads the extracted authority data line by line into the
+    "records" table of an SQLite store, so the collection never has to fit in memory. Records that appear
+    more than once are merged as in process_txt_to_pd and unmatched values are logged as they are found.
+    Each record gets the row_group that reproduces the row order of the DataFrame built by process_txt_to_pd.
+    Returns the identifier prefixes in the column order of that DataFrame.
+    '''
+    conn.execute('CREATE TABLE records (key_khi TEXT PRIMARY KEY, prefix_order TEXT, row_group INTEGER)')
+    store_columns = []
+
+    with open(input_file, 'r') as f, open('unmatched_authority_data.txt', 'a') as log_file:
+        for line in f:
+            # Strip whitespace and skip empty lines
+            line = line.strip()
+            if not line:
+                continue
+
+            # Split the line into key and values
+            parts = [part.strip() for part in line.split(',')]
+            key_khi = parts[0]
+            record = {}
+
+            # Process each value to extract prefix and number
+            for value in parts[1:]:
+                if value:
+                    match = re.match(r"([a-zA-Z]+)(\d+)", value)
+                    if match:
+                        prefix = match.group(1).lower()
+                        record[prefix] = match.group(2)
+                        if prefix not in store_columns:
+                            store_columns.append(prefix)
+                            conn.execute(f'ALTER TABLE records ADD COLUMN "{prefix}" TEXT')
+                    else:
+                        log_file.write(f"{value}\n")
+
+            # A record keeps the position of its first line, even if that line has no identifiers;
+            # records that never get one are left out of the partitions, as DataFrame.from_dict leaves them out
+            if not record:
+                conn.execute("INSERT OR IGNORE INTO records (key_khi, prefix_order) VALUES (?, '')", (key_khi,))
+                continue
+
+            # Later values overwrite earlier ones, prefixes keep the position of their first appearance
+            existing = conn.execute('SELECT prefix_order FROM records WHERE key_khi = ?', (key_khi,)).fetchone()
+            prefix_order = existing[0].split(',') if existing and existing[0] else []
+            prefix_order += [prefix for prefix in record if prefix not in prefix_order]
+
+            columns = ', '.join(f'"{prefix}"' for prefix in record)
+            placeholders = ', '.join('?' for _ in range(len(record) + 2))
+            updates = ', '.join(f'"{prefix}" = excluded."{prefix}"' for prefix in ['prefix_order', *record])
+            conn.execute(f'INSERT INTO records (key_khi, prefix_order, {columns}) VALUES ({placeholders}) '
+                         f'ON CONFLICT (key_khi) DO UPDATE SET {updates}',
+                         [key_khi, ','.join(prefix_order), *record.values()])
+
+    # DataFrame.from_dict orders the columns by first appearance in the merged records...
+    unique_prefixes = []
+    for (prefix_order,) in conn.execute("SELECT prefix_order FROM records WHERE prefix_order != '' ORDER BY rowid"):
+        for prefix in prefix_order.split(','):
+            if prefix not in unique_prefixes:
+                unique_prefixes.append(prefix)
+
+    # ...and lists the records having the first column, then the remaining ones having the second, and so on
+    column_rank = {prefix: rank for rank, prefix in enumerate(unique_prefixes)}
+    last_rowid = 0
+    while True:
+        rows = conn.execute('SELECT rowid, prefix_order FROM records WHERE rowid > ? ORDER BY rowid LIMIT 10000',
+                            (last_rowid,)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        # Records without identifiers keep a NULL row_group and are never selected
+        conn.executemany('UPDATE records SET row_group = ? WHERE rowid = ?',
+                         [(min(column_rank[prefix] for prefix in prefix_order.split(',')), rowid)
+                          for rowid, prefix_order in rows if prefix_order])
+    conn.execute('CREATE INDEX records_row_group ON records (row_group)')
+
+    conn.commit()
+    return unique_prefixes
+
+
+def process_and_map_data_chunked(folder_path, WD_SPARQL_ENDPOINT, chunk_size=50000, memory_limit_mb=None, work_dir=None,
+                                 reuse_results=True, lookup_store=DEFAULT_STORE):
+    '''
+    Memory-bounded variant of process_and_map_data for collections larger than RAM.
+    Authority data is staged in an on-disk SQLite store and mapped in partitions of chunk_size records, which
+    are appended to a spill file; empty columns are removed while copying it to the ordered csv file.
+    If memory_limit_mb is given, it is a ceiling for the peak resident memory: every partition is sized to use at most
+    half of the memory left under it (and at most chunk_size records), based on the memory per record observed so far,
+    and a MemoryError is raised as soon as the peak resident memory exceeds it.
+    Produces the same csv file as process_and_map_data and returns its name.
+    '''
+    output_initial_extraction=extract_authority_data(folder_path)
+    ordered_csv_output = f"ordered_{output_initial_extraction[:-4]}.csv"
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        conn = sqlite3.connect(os.path.join(tmp_dir, 'authority_store.sqlite'))
+        spill_csv = os.path.join(tmp_dir, 'mapped_partitions.csv')
+        try:
+            with metrics.stage("txt_to_store"):
+                unique_prefixes = load_txt_to_store(output_initial_extraction, conn)
+
+            # Same column order as process_txt_to_pd followed by the "wd" column
+            columns = ['key_khi'] + unique_prefixes
+            columns += [prefix for prefix in prefixes_dict.values() if prefix not in columns] + ['wd']
+            non_empty_columns = set()
+
+            partition_size = chunk_size
+            mb_per_record = PARTITION_MB_PER_RECORD
+            last_position = (-1, 0)
+            mapped_records = 0
+            progress = ProgressReporter("Records mapped")
+            partition_query = ('SELECT row_group, rowid AS store_rowid, key_khi, '
+                               + ', '.join(f'"{prefix}"' for prefix in unique_prefixes)
+                               + ' FROM records WHERE row_group IS NOT NULL AND (row_group, rowid) > (?, ?) '
+                               'ORDER BY row_group, rowid LIMIT ?')
+
+            while True:
+                if memory_limit_mb is not None:
+                    rss_before = current_rss_mb()
+                    peak_before = peak_rss_mb()
+                    headroom = memory_limit_mb - rss_before
+                    if headroom <= 0:
+                        raise MemoryError(f"Resident memory of {rss_before:.0f} MB is already above the limit of {memory_limit_mb} MB")
+                    partition_size = max(1, min(chunk_size, int(0.5 * headroom / mb_per_record)))
+
+                partition = pd.read_sql_query(partition_query, conn, params=(*last_position, partition_size))
+                if partition.empty:
+                    break
+                last_position = (int(partition['row_group'].iloc[-1]), int(partition['store_rowid'].iloc[-1]))
+                metrics.inc("partitions_total")
+
+                # Same filtering and missing columns as process_txt_to_pd
+                authority_df = partition.drop(columns=['row_group', 'store_rowid'])
+                authority_df = authority_df.loc[authority_df['key_khi'].str.match(r'^oai_kue_0*7')]
+                authority_df.reset_index(drop=True, inplace=True)
+                for prefix in prefixes_dict.values():
+                    if prefix not in authority_df.columns:
+                        authority_df[prefix] = pd.NA
+                del partition
+
+                output_df = map_authority_dataframe(authority_df, WD_SPARQL_ENDPOINT, reuse_results).reindex(columns=columns)
+                non_empty_columns.update(col for col in columns if output_df[col].notna().any())
+                output_df.to_csv(spill_csv, mode='a', header=False, index=False)
+                mapped_records += len(output_df)
+                progress.update(len(output_df), partition_size=partition_size)
+                partition_records = len(authority_df)
+                del authority_df, output_df
+
+                peak_after = peak_rss_mb()
+                metrics.observe_max("peak_rss_mb", peak_after)
+                if memory_limit_mb is not None:
+                    if peak_after > memory_limit_mb:
+                        metrics.inc("memory_limit_exceeded_total")
+                        raise MemoryError(f"Peak resident memory of {peak_after:.0f} MB exceeded the limit of {memory_limit_mb} MB "
+                                          f"with partitions of {partition_size} records")
+                    # Memory used by this partition, from the new peak if it set one
+                    growth = (peak_after if peak_after > peak_before else current_rss_mb()) - rss_before
+                    if partition_records and growth > 0:
+                        mb_per_record = max(mb_per_record, growth / partition_records)
+        finally:
+            conn.close()
+
+        # Remove empty columns while copying the spill file to the output
+        with metrics.stage("write_csv"):
+            keep = [i for i, col in enumerate(columns) if col in non_empty_columns]
+            with open(ordered_csv_output, 'w', newline='') as f_out:
+                writer = csv.writer(f_out, lineterminator=os.linesep)
+                writer.writerow([columns[i] for i in keep])
+                if os.path.exists(spill_csv):
+                    with open(spill_csv, 'r', newline='') as f_in:
+                        for row in csv.reader(f_in):
+                            writer.writerow([row[i] for i in keep])
+
+    metrics.inc("bytes_written_total", os.path.getsize(ordered_csv_output), output="csv")
+    metrics.inc("mapped_records_total", mapped_records)
+    print(f"Results saved to {ordered_csv_output}")
+
+    if lookup_store is not None:
+        write_lookup_store(ordered_csv_output, lookup_store)
+    return ordered_csv_output
+
+
+def extract_map_replace_xml(folder_path, chunk_size=None, memory_limit_mb=None, work_dir=None, reuse_results=True,
+                            lookup_store=DEFAULT_STORE):
     '''
     Calls previous function to create a DataFrame with authority file data mappings.
     Iterate over the XML in the specified folder to find matches with file names in the DataFrame and replaces the content
     of <a30gn> with the corresponding DataFrame row, joining its content with ; as separator.
+    If chunk_size is given, the chunked mode is used and the mapping csv is read back row by row;
+    no DataFrame is returned in that case.
     '''
-    mapping_dataframe, mapping_csv = process_and_map_data(folder_path, WD_SPARQL_ENDPOINT)
+    if chunk_size is None:
+        mapping_dataframe, mapping_csv = process_and_map_data(folder_path, WD_SPARQL_ENDPOINT, reuse_results, lookup_store)
 
-    namespaces = {'default': 'http://www.openarchives.org/OAI/2.0/'}
+        with metrics.stage("replace_xml"):
+            replace_xml_content(mapping_dataframe, folder_path)
+    else:
+        mapping_dataframe = None
+        mapping_csv = process_and_map_data_chunked(folder_path, WD_SPARQL_ENDPOINT, chunk_size, memory_limit_mb, work_dir,
+                                                   reuse_results, lookup_store)
+
+        with metrics.stage("replace_xml"):
+            replace_xml_content_from_csv(mapping_csv, folder_path)
+
+    print("Process completed.")
+    return mapping_dataframe, mapping_csv
+
+
+def replace_xml_content(mapping_dataframe, folder_path):
+    '''
+    Writes the joined authority data of each mapped record into the <a30gn> element of its XML file.
+    '''
+    progress = ProgressReporter("XML records updated", total=len(mapping_dataframe))
 
     for index, row in mapping_dataframe.iterrows():
         file_name = row['key_khi']  # Assuming key_khi holds the file name
-        
-        file_path = os.path.join(folder_path, file_name)
+        joined_values = "; ".join(str(value) for value in row[1:] if pd.notna(value))
+        write_a30gn(folder_path, file_name, joined_values)
+        progress.update()
 
-        if os.path.exists(file_path):
-            joined_values = "; ".join(str(value) for value in row[1:] if pd.notna(value))
-            
-            try:
-                tree = ET.parse(file_path)
-                root = tree.getroot()
+    progress.report()
 
-                a30gn_element = root.find('.//default:a30gn', namespaces)
 
-                if a30gn_element is not None:
-                    a30gn_element.text = joined_values
-                    
-                    tree.write(file_path, encoding='utf-8', xml_declaration=True)
-                    print(f"Replaced content in file {file_name}")
-                else:
-                    print(f"<a30gn> element not found in {file_name}")
-                    
-            except Exception as e:
-                print(f"Error processing file {file_name}: {e}")
-        else:
-            print(f"File {file_name} not found in the folder.")
+def replace_xml_content_from_csv(mapping_csv, folder_path):
+    '''
+    Streaming counterpart of replace_xml_content for the chunked mode: reads the mapping csv file row by row,
+    so the memory used does not grow with the number of records.
+    '''
+    progress = ProgressReporter("XML records updated")
 
-    print("Process completed.")
-    return mapping_dataframe, mapping_csv
+    with open(mapping_csv, 'r', newline='') as f_in:
+        reader = csv.reader(f_in)
+        header = next(reader, None)
+        for row in reader:
+            # Empty fields are missing identifiers, except "wd", which is empty for unmapped records
+            joined_values = "; ".join(value for col, value in zip(header[1:], row[1:]) if value or col == 'wd')
+            write_a30gn(folder_path, row[0], joined_values)
+            progress.update()
+
+    progress.report()
+
+
+def write_a30gn(folder_path, file_name, joined_values):
+    '''
+    Writes the joined authority data of a record into the <a30gn> element of its XML file.
+    '''
+    namespaces = {'default': 'http://www.openarchives.org/OAI/2.0/'}
+    file_path = os.path.join(folder_path, file_name)
+
+    if os.path.exists(file_path):
+        try:
+            tree = ET.parse(file_path)
+            root = tree.getroot()
+
+            a30gn_element = root.find('.//default:a30gn', namespaces)
+
+            if a30gn_element is not None:
+                a30gn_element.text = joined_values
+                
+                tree.write(file_path, encoding='utf-8', xml_declaration=True)
+                metrics.inc("xml_records_updated_total")
+                metrics.inc("bytes_written_total", os.path.getsize(file_path), output="xml")
+            else:
+                metrics.inc("xml_records_skipped_total", reason="no_a30gn")
+                print(f"<a30gn> element not found in {file_name}")
+                
+        except Exception as e:
+            metrics.inc("xml_records_skipped_total", reason="error")
+            print(f"Error processing file {file_name}: {e}")
+    else:
+        metrics.inc("xml_records_skipped_total", reason="missing_file")
+        print(f"File {file_name} not found in the folder.")
 
 
 if __name__ == '__main__':
@@ -413,11 +791,37 @@ if __name__ == '__main__':
 
     # Add a positional argument for the folder_path
     parser.add_argument('folder_path', type=str, help='Path to the folder containing XML files')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='Export run metrics to this file (.prom for a Prometheus textfile, otherwise JSON lines)')
+    parser.add_argument('--profile', type=int, default=0, metavar='N',
+                        help='Profile one out of every N calls of the hot functions (0 disables profiling)')
+    parser.add_argument('--chunk-size', type=int, default=None, metavar='N',
+                        help='Map the records in partitions of N records backed by an on-disk store (chunked mode)')
+    parser.add_argument('--memory-limit-mb', type=int, default=None,
+                        help='In chunked mode, size the partitions to keep the peak resident memory under this limit '
+                             'and stop with an error if it is exceeded')
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='Directory for the temporary on-disk store of the chunked mode')
+    parser.add_argument('--no-query-reuse', action='store_true',
+                        help='Query every Wikidata entity again in the reverse mapping instead of reusing the forward results')
+    parser.add_argument('--lookup-store', type=str, default=DEFAULT_STORE,
+                        help='Indexed lookup store updated with the mapping (see authority_lookup.py)')
+    parser.add_argument('--no-lookup-store', action='store_true', help='Do not update the lookup store')
 
     # Parse the arguments
     args = parser.parse_args()
 
+    if args.profile > 0:
+        metrics.enable_profiling(args.profile)
+
     # Call the main function to extract, map, and replace XML content
-    mapping_result, mapping_result_csv = extract_map_replace_xml(args.folder_path)
+    try:
+        mapping_result, mapping_result_csv = extract_map_replace_xml(args.folder_path, args.chunk_size,
+                                                                     args.memory_limit_mb, args.work_dir,
+                                                                     not args.no_query_reuse,
+                                                                     None if args.no_lookup_store else args.lookup_store)
+    finally:
+        if args.metrics:
+            metrics.export(args.metrics)
 
 
@@ -1,8 +1,10 @@
 # AUXILIARY FUNCTIONS FOR SPARQL QUERIES IN STEP 2
-def build_sparql_query(prefix, values):
+def build_sparql_query(prefix, values, expand=False):
     '''
     Builds SPARQL query based on identifier. GNDs, ULANs, and VIAFs are mapped to Wikidata entities,
     then Wikidata entities are used to retrieve additional missing GNDs, ULANs, and VIAFs.
+    With expand, GND, ULAN, and VIAF queries also return all GNDs, ULANs, and VIAFs of the matched entities
+    (as ?wd_gnd, ?wd_ulan, ?wd_viaf), so these entities need no second query.
     '''
     # Common SELECT clause
     select_clause = f"""
@@ -38,6 +40,16 @@ def build_sparql_query(prefix, values):
     else:
         raise NotImplementedError(f"This prefix is not implemented: {prefix}")
 
+    if expand and prefix != 'wd':
+        select_clause = f"""
+    SELECT ?{prefix} ?wd ?wd_gnd ?wd_ulan ?wd_viaf WHERE {{
+    """
+        query_section += """
+            OPTIONAL { ?wd wdt:P227 ?wd_gnd. }
+            OPTIONAL { ?wd wdt:P245 ?wd_ulan. }
+            OPTIONAL { ?wd wdt:P214 ?wd_viaf. }
+        """
+
     # Complete query
     query = f"{select_clause} {values_clause} {query_section} }}"
 
@@ -61,13 +73,13 @@ def execute_sparql_query(endpoint, query):
         return None
 
 
-def process_authority(prefix, values, WD_SPARQL_ENDPOINT):
+def process_authority(prefix, values, WD_SPARQL_ENDPOINT, expand=False):
     '''
     Builds a SPARQL query based on the provided prefix and values,
     then executes the query on the specified Wikidata SPARQL endpoint.
     Returns the query result.
     '''
-    query = build_sparql_query(prefix, values)
+    query = build_sparql_query(prefix, values, expand)
     if query is None:
         print("The query was not generated.")
         return None
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Instrumentation shared by the harvesting and mapping scripts: per-stage timers, counters, gauges and
+latency histograms exported as JSON lines or as a Prometheus textfile, sampled cProfile profiling of
+hot functions and rate-limited progress reporting.
+'''
+
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Metrics:
+    '''
+    Collects per-stage timers, counters and latency histograms for a run.
+    Results are exported as one JSON line per run or as a Prometheus textfile (.prom).
+    Functions decorated with profiled() are sampled with cProfile once profiling is enabled.
+    '''
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.counters = defaultdict(float)
+        self.timers = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        self.profiler = None
+        self.profile_every = 0
+        self._profile_calls = defaultdict(int)
+        self._profiling = False
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, {"buckets": [0] * len(self.LATENCY_BUCKETS), "count": 0, "sum": 0.0})
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+
+    def observe_max(self, name, value):
+        # Keeps the highest value seen for a gauge, e.g. peak memory
+        with self._lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    @contextmanager
+    def stage(self, name):
+        # Accumulates wall time spent in a named stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.timers[name] += time.perf_counter() - start
+
+    @contextmanager
+    def timed(self, name, **labels):
+        # Records the duration of a single operation into a latency histogram
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def enable_profiling(self, sample_every=1):
+        '''
+        Profiles one out of every sample_every calls of each profiled() function.
+        '''
+        self.profiler = cProfile.Profile()
+        self.profile_every = max(int(sample_every), 1)
+
+    def profiled(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.profiler is None or self._profiling:
+                return func(*args, **kwargs)
+            with self._lock:
+                self._profile_calls[func.__name__] += 1
+                # The profiler is shared: only one thread at a time may run a sampled call under it
+                sampled = not self._profiling and self._profile_calls[func.__name__] % self.profile_every == 0
+                if sampled:
+                    self._profiling = True
+            if not sampled:
+                return func(*args, **kwargs)
+            try:
+                return self.profiler.runcall(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self._profiling = False
+        return wrapper
+
+    def _series_name(self, name, labels):
+        if not labels:
+            return f"{self.namespace}_{name}"
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        return f"{self.namespace}_{name}{{{label_text}}}"
+
+    def to_prometheus(self):
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            # Each metric family gets a single TYPE line, as required by the text format
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {self.namespace}_{name} {metric_type}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{self._series_name(name, labels)} {format_value(value)}")
+        for name, value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{self._series_name(name, ())} {format_value(value)}")
+        for stage_name, seconds in sorted(self.timers.items()):
+            declare("stage_seconds", "gauge")
+            lines.append(f"{self._series_name('stage_seconds', (('stage', stage_name),))} {seconds:.6f}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            for bound, count in zip(self.LATENCY_BUCKETS, histogram["buckets"]):
+                lines.append(f"{self._series_name(name + '_bucket', labels + (('le', bound),))} {count}")
+            lines.append(f"{self._series_name(name + '_bucket', labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{self._series_name(name + '_sum', labels)} {histogram['sum']:.6f}")
+            lines.append(f"{self._series_name(name + '_count', labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {
+            "timestamp": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(self.counters.items())],
+            "stages": dict(self.timers),
+            "gauges": dict(self.gauges),
+            "histograms": [{"name": name, "labels": dict(labels), "le": list(self.LATENCY_BUCKETS), **histogram}
+                           for (name, labels), histogram in sorted(self.histograms.items())],
+        }
+
+    def export(self, path):
+        '''
+        Writes the collected metrics to path: Prometheus textfile if it ends in .prom,
+        otherwise one JSON line is appended. Profiling stats, if any call was sampled, go to path + ".pstats".
+        '''
+        if path.endswith('.prom'):
+            # Write and rename so the node exporter never reads a partial file
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f_out:
+                f_out.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        else:
+            with open(path, 'a') as f_out:
+                f_out.write(json.dumps(self.to_dict()) + "\n")
+        # pstats cannot be built from a profiler that has not sampled any call yet
+        if self.profiler is not None and self.profiler.getstats():
+            self.profiler.dump_stats(f"{path}.pstats")
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(15)
+
+
+def format_value(value):
+    # Exact textfile value: integral counts as integers, other values with full precision
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class ProgressReporter:
+    '''
+    Rate-limited replacement for per-record prints: reports at most once every interval seconds.
+    '''
+    def __init__(self, label, total=None, interval=5.0):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start = time.monotonic()
+        self._last_report = self.start
+
+    def update(self, n=1, **info):
+        self.count += n
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(**info)
+
+    def report(self, **info):
+        elapsed = time.monotonic() - self.start
+        rate = self.count / elapsed if elapsed > 0 else 0.0
+        progress = f"{self.count}/{self.total}" if self.total is not None else f"{self.count}"
+        details = "".join(f", {key}: {value}" for key, value in info.items())
+        print(f"{self.label}: {progress} ({rate:.1f}/s{details})")
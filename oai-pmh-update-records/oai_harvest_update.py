@@ -3,8 +3,94 @@
 from sickle import Sickle
 #from sickle.iterator import OAIResponseIterator
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import os
 import re
+import time
+import threading
+import sys
+from contextlib import contextmanager
+
+# instrumentation.py is shared by both scripts and lives in the root folder of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import Metrics, ProgressReporter
+
+
+
+metrics = Metrics("khi_harvest")
+
+
+
+# Limits per OAI-PMH host: concurrent requests and minimum seconds between two requests
+DEFAULT_HOST_LIMITS = {'max_connections': 2, 'min_interval': 0.0}
+HOST_LIMITS = {}
+
+
+
+class HostLimiter:
+    """
+    Limits the concurrent requests to one host and spaces them by at least min_interval seconds.
+    Shared by all harvest jobs that use the same host.
+    """
+    def __init__(self, max_connections=2, min_interval=0.0):
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    @contextmanager
+    def request(self):
+        with self.semaphore:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._next_request - now
+                self._next_request = max(now, self._next_request) + self.min_interval
+            if wait > 0:
+                time.sleep(wait)
+            yield
+
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+def get_host_limiter(endpoint):
+    # Returns the limiter of the endpoint's host, creating it from HOST_LIMITS on first use
+    host = urlparse(endpoint).netloc
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = HostLimiter(**HOST_LIMITS.get(host, DEFAULT_HOST_LIMITS))
+        return _host_limiters[host]
+
+
+
+class InstrumentedSickle(Sickle):
+    """
+    Sickle client that records the latency of every OAI-PMH HTTP request and counts pages and retries.
+    Every request, retries included, goes through the limiter of the endpoint's host.
+    """
+    def harvest(self, **kwargs):
+        metrics.inc("oai_pages_total", verb=kwargs.get('verb'))
+        return super().harvest(**kwargs)
+
+    def _request(self, kwargs):
+        # Limited and timed per HTTP request: Sickle sleeps between retries in harvest(), without holding
+        # a connection slot, and that sleep is not request latency
+        with get_host_limiter(self.endpoint).request(), metrics.timed("oai_request_seconds"):
+            return super()._request(kwargs)
+
+    def get_retry_after(self, http_response):
+        # Only called by Sickle when a request is about to be retried
+        metrics.inc("oai_retries_total")
+        return super().get_retry_after(http_response)
+
+
+# Supported date formats in a single pattern: YYYY, YYYY-MM, YYYY-MM-DD, YYYY-MM-DDThh:mm, YYYY-MM-DDThh:mm:ss[Z]
+DATETIME_PATTERN = re.compile(r'(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})Z?)?)?)?)?')
+
+# The watermark file is rewritten with its last entry once it grows beyond this size
+WATERMARK_COMPACT_BYTES = 4096
 
 
 
@@ -33,6 +119,17 @@ def complete_datetime(date_str):
     # Strip any leading/trailing whitespace
     date_str = date_str.strip()
 
+    # Fast path: zero-padded dates are completed in a single pass
+    match = DATETIME_PATTERN.fullmatch(date_str)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        try:
+            # Validates month, day and time ranges as strptime would
+            datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0), int(second or 0))
+        except ValueError:
+            raise ValueError(f"Date '{date_str}' is not in a valid format.")
+        return f"{year}-{month or '01'}-{day or '01'}T{hour or '00'}:{minute or '00'}:{second or '00'}Z"
+
     # Define formats for parsing
     formats = [
         '%Y-%m-%dT%H:%M:%SZ',   # Full format
@@ -76,24 +173,39 @@ def select_directory(oai_identifier, base_output_dir, category_mapping):
             if key in oai_identifier.lower():
                 # If the key is found, create the corresponding directory
                 output_dir = os.path.join(base_output_dir, category)
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
+                os.makedirs(output_dir, exist_ok=True)
                 return output_dir
     # If no key is found, assign the record to 'uncategorized'
     output_dir = os.path.join(base_output_dir, 'uncategorized')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
     return output_dir
 
 
 
+def read_last_line(txtpath, block_size=1024):
+    # Reads the last non-empty line by seeking backwards from the end of the file
+    with open(txtpath, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        buffer = b''
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            file.seek(position)
+            buffer = file.read(step) + buffer
+            stripped = buffer.rstrip()
+            if b'\n' in stripped:
+                break
+    return buffer.rstrip().rsplit(b'\n', 1)[-1].decode('utf-8').strip()
+
+
+
 def read_last_date_from_file(txtpath):
     # Reads the last date entry from the specified file or returns a default date.
     try:
-        with open(txtpath, 'r') as file:
-            lines = file.readlines()
-        if lines and re.match(r'^\d{4}', lines[-1].strip()):
-            return complete_datetime(lines[-1].strip())
+        last_line = read_last_line(txtpath)
+        if re.match(r'^\d{4}', last_line):
+            return complete_datetime(last_line)
         return "2015-01-01T00:00:00Z"
     except FileNotFoundError:
         raise FileNotFoundError(f"File at '{txtpath}' not found. Please provide a valid path.")
@@ -103,15 +215,37 @@ def read_last_date_from_file(txtpath):
 
 
 def append_current_date_to_file(txtpath, date_to_write = None):
-    # Appends the current date to the specified file.
+    # Appends the current date to the specified file, compacting it to its last entry once it gets too large.
     if date_to_write is None:
         date_to_write = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-    with open(txtpath, 'a') as file:
-        file.write('\n' + date_to_write)
+    if os.path.exists(txtpath) and os.path.getsize(txtpath) > WATERMARK_COMPACT_BYTES:
+        # Old entries are covered by the harvest history, only the watermark itself is needed
+        tmp_path = f"{txtpath}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(date_to_write)
+        os.replace(tmp_path, txtpath)
+        metrics.inc("watermark_compactions_total")
+    else:
+        with open(txtpath, 'a') as file:
+            file.write('\n' + date_to_write)
     return date_to_write
 
 
 
+def history_path_for(txtpath):
+    # The harvest history is kept next to the watermark file, e.g. harvest_date_history.log
+    root, ext = os.path.splitext(txtpath)
+    return f"{root}_history{ext or '.log'}"
+
+
+
+def append_harvest_history(txtpath, fromdate, untildate, response_count, started_at):
+    # Appends one audit line per harvest run: start time, harvested timespan and number of records.
+    finished_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    with open(history_path_for(txtpath), 'a') as file:
+        file.write(f"{started_at}\t{finished_at}\t{fromdate}\t{untildate}\t{response_count}\n")
+
+
 
 def handle_dates(txtpath=None):
     if txtpath is None:
@@ -124,7 +258,8 @@ def handle_dates(txtpath=None):
 
 
 
-def save_record(response, output_dir, oai_identifier):
+@metrics.profiled
+def save_record(response, output_dir, oai_identifier, metadataprefix='khi'):
     # Remove the unwanted part: '30gn= gnd...' or ' 30gn= gnd...'
     clean_identifier = re.sub(r'\s+.*30gn= [^\s]+', '', oai_identifier)
 
@@ -132,13 +267,15 @@ def save_record(response, output_dir, oai_identifier):
     safe_oai_identifier = clean_identifier.replace('/', '_').replace('::', '_')
 
     # Create the file path
-    file_path = os.path.join(output_dir, f'{safe_oai_identifier}.khi.xml')
+    file_path = os.path.join(output_dir, f'{safe_oai_identifier}.{metadataprefix}.xml')
 
     # Save the response to the file
+    content = response.raw.encode('utf8')
     with open(file_path, 'wb') as fp:
-        fp.write(response.raw.encode('utf8'))
+        fp.write(content)
 
-    print(f"Saved response to '{file_path}'")
+    metrics.inc("bytes_written_total", len(content))
+    return file_path
 
 
 
@@ -150,15 +287,17 @@ def harvest_timespan(provider,
                      oaiset=None,
                      record_type_dict=None,
                      base_output_dir = None,
+                     record_history=True,
                     ):
     # Ensure that provider is specified
     if provider is None:
         raise ValueError("Please specify a data provider.")
     if base_output_dir is None:
         base_output_dir = 'dataset_xml'
+    started_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
     # Initialize Sickle
-    sickle = Sickle(provider) #, iterator=OAIResponseIterator
+    sickle = InstrumentedSickle(provider) #, iterator=OAIResponseIterator
 
     # Handle the date logic
     if fromdate is None:
@@ -173,6 +312,7 @@ def harvest_timespan(provider,
 
     # Set the limit for downloads
     response_count = 0
+    progress = ProgressReporter(f"Records saved ({fromdate_completed} - {untildate})")
     #max_downloads = 20 # For testing
 
 
@@ -185,6 +325,7 @@ def harvest_timespan(provider,
             response = responses.next()
             oai_identifier = response.header.identifier
             if not oai_identifier:
+                metrics.inc("records_skipped_total")
                 print(f"Identifier not found in the response. Skipping...")
                 continue
 
@@ -192,15 +333,19 @@ def harvest_timespan(provider,
             output_dir = select_directory(oai_identifier, base_output_dir, record_type_dict)
 
             # Save the response
-            save_record(response, output_dir, oai_identifier)
+            save_record(response, output_dir, oai_identifier, metadataprefix)
 
             response_count += 1
+            metrics.inc("records_harvested_total", category=os.path.basename(output_dir))
+            progress.update()
 
         except StopIteration:
             break
 
     print(f"Total {response_count} records saved.")
     append_current_date_to_file(txtpath, untildate)
+    if record_history:
+        append_harvest_history(txtpath, fromdate_completed, untildate, response_count, started_at)
     return response_count
 
 
@@ -210,11 +355,14 @@ def harvest_timespan_safe(provider,
                           txtpath=None,
                           untildate=None,
                           oaiset=None,
-                          record_type_dict=None):
+                          record_type_dict=None,
+                          base_output_dir=None):
     # Ensure that provider is specified
     if provider is None:
         raise ValueError("Please specify a data provider.")
 
+    started_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
     # Handle the date logic
     fromdate, txtpath = handle_dates(txtpath)
     fromdate = complete_datetime(fromdate)
@@ -229,44 +377,99 @@ def harvest_timespan_safe(provider,
 
     current_date = fromdate_dt
 
-    while current_date <= untildate_dt:
-        next_date = current_date + timedelta(days=1)
-        date_str = current_date.strftime('%Y-%m-%dT%H:%M:%SZ')
-        next_date_str = next_date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Jobs run concurrently, so the stage is kept per job: a shared stage would sum the jobs' times
+    job_name = harvest_job_name({'provider': provider, 'set': oaiset, 'metadataprefix': metadataprefix})
+    with metrics.stage(f"harvest_{job_name}"):
+        while current_date <= untildate_dt:
+            next_date = current_date + timedelta(days=1)
+            date_str = current_date.strftime('%Y-%m-%dT%H:%M:%SZ')
+            next_date_str = next_date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+            # Debugging prints
+            #print(f"Requesting records from {date_str} to {next_date_str}")
+
+            # Call harvest_timespan with the current date range
+            try:
+                count = harvest_timespan(
+                    provider=provider,
+                    metadataprefix=metadataprefix,
+                    txtpath=txtpath,
+                    fromdate=date_str,
+                    untildate=next_date_str,
+                    oaiset=oaiset,
+                    record_type_dict=record_type_dict,
+                    base_output_dir=base_output_dir,
+                    record_history=False
+                )
+            except Exception as e:
+                count = 0  # Handle or log error as needed
+                metrics.inc("harvest_window_errors_total")
+
+            response_count += count
+
+            if count > 0:
+                print(f"Found {count} records for {date_str}")
+            #else:
+            #    print(f"No records found for {date_str}")
+
+            # For testing:
+            #if response_count >= max_downloads:
+            #    print(f"Download limit reached: {max_downloads} records.")
+            #    return response_count
+
+            current_date = next_date
 
-        # Debugging prints
-        #print(f"Requesting records from {date_str} to {next_date_str}")
+    print(f"Total {response_count} records saved.")
+    append_harvest_history(txtpath, fromdate, untildate, response_count, started_at)
+    return response_count
 
-        # Call harvest_timespan with the current date range
-        try:
-            count = harvest_timespan(
-                provider=provider,
-                metadataprefix=metadataprefix,
-                txtpath=txtpath,
-                fromdate=date_str,
-                untildate=next_date_str,
-                oaiset=oaiset,
-                record_type_dict=record_type_dict
-            )
-        except Exception as e:
-            count = 0  # Handle or log error as needed
-
-        response_count += count
-
-        if count > 0:
-            print(f"Found {count} records for {date_str}")
-        #else:
-        #    print(f"No records found for {date_str}")
-
-        # For testing:
-        #if response_count >= max_downloads:
-        #    print(f"Download limit reached: {max_downloads} records.")
-        #    return response_count
 
-        current_date = next_date
 
-    print(f"Total {response_count} records saved.")
-    return response_count
+def harvest_job_name(job):
+    # Identifies a harvest job by host, set and metadata prefix
+    return f"{urlparse(job['provider']).netloc}/{job.get('set') or 'all'}/{job['metadataprefix']}"
+
+
+
+def default_watermark_path(job):
+    # Every job keeps its own watermark, e.g. harvest_date_partner.org_website_oai_dc.log
+    host = urlparse(job['provider']).netloc.replace(':', '_')
+    return f"harvest_date_{host}_{job.get('set') or 'all'}_{job['metadataprefix']}.log"
+
+
+
+def run_harvest_jobs(jobs, base_output_dir=None, max_workers=None):
+    """
+    Runs harvest_timespan_safe for every job concurrently and returns the number of records per job.
+    A job is a dict with 'provider', 'metadataprefix' and optionally 'set', 'category_mapping' and 'txtpath'.
+    All jobs write to the same output directory; requests to each host are limited by HOST_LIMITS.
+    """
+    results = {}
+    if not jobs:
+        return results
+
+    with metrics.stage("scheduler"), ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+        futures = {
+            executor.submit(harvest_timespan_safe,
+                            provider=job['provider'],
+                            metadataprefix=job['metadataprefix'],
+                            txtpath=job.get('txtpath') or default_watermark_path(job),
+                            oaiset=job.get('set'),
+                            record_type_dict=job.get('category_mapping'),
+                            base_output_dir=base_output_dir): harvest_job_name(job)
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            job_name = futures[future]
+            try:
+                results[job_name] = future.result()
+                print(f"Harvest job {job_name} finished: {results[job_name]} records")
+            except Exception as e:
+                metrics.inc("harvest_job_errors_total")
+                print(f"Harvest job {job_name} failed: {e}")
+                results[job_name] = 0
+
+    return results
 
 
 
@@ -281,6 +484,23 @@ category_mapping = {
     '::oau::': 'exhibition_presentation'
 }
 
+# Harvest jobs, run concurrently: each (provider, set, metadata prefix) keeps its own watermark file
+harvest_jobs = [
+    {'provider': provider_khi, 'set': oai_set, 'metadataprefix': metadata_prefix,
+     'category_mapping': category_mapping, 'txtpath': 'harvest_date.log'},
+    # Further sets, metadata prefixes or partner endpoints, e.g.:
+    #{'provider': "https://partner.example.org/oai", 'set': None, 'metadataprefix': 'oai_dc', 'category_mapping': None},
+]
+
+# Per-host request limits, hosts not listed here use DEFAULT_HOST_LIMITS, e.g.:
+#HOST_LIMITS['partner.example.org'] = {'max_connections': 1, 'min_interval': 1.0}
+
+# Metrics export (.prom for a Prometheus textfile, otherwise JSON lines) and optional profiling of one in N calls
+metrics_output = os.environ.get('KHI_HARVEST_METRICS')
+profile_every = int(os.environ.get('KHI_HARVEST_PROFILE', '0'))
+if profile_every > 0:
+    metrics.enable_profiling(profile_every)
+
 
 
 # Call with txt path
@@ -289,9 +509,16 @@ category_mapping = {
 # Call with from-date
 #records_khi=harvest_timespan(provider=provider_khi, metadataprefix=metadata_prefix, txtpath="harvest_date_log.txt", oaiset=oai_set, record_type_dict=category_mapping)
 
-# Safe harvest - 1 day iterations to avoid timeout
-records_khi_safe=harvest_timespan_safe(provider=provider_khi, metadataprefix=metadata_prefix, oaiset=oai_set, record_type_dict=category_mapping)
-print(f"Total records harvested: {records_khi_safe}")
+# Safe harvest of a single job - 1 day iterations to avoid timeout
+#records_khi_safe=harvest_timespan_safe(provider=provider_khi, metadataprefix=metadata_prefix, oaiset=oai_set, record_type_dict=category_mapping)
+
+# Safe harvest of all jobs, run concurrently
+try:
+    records_per_job=run_harvest_jobs(harvest_jobs)
+    print(f"Total records harvested: {sum(records_per_job.values())}")
+finally:
+    if metrics_output:
+        metrics.export(metrics_output)
 
 
 
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The scripts are not packaged; make them and the shared instrumentation module importable
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+for folder in ('authority-file-mapping', 'oai-pmh-update-records'):
+    sys.path.insert(0, os.path.join(REPO_ROOT, folder))
@@ -0,0 +1,61 @@
+'''
+Checks the lookup store: each mapping csv file replaces the identifiers of its records and keeps the other records,
+and identifiers are stored and looked up without their prefix.
+'''
+import pytest
+
+from authority_lookup import AuthorityLookup, update_lookup_store
+
+
+def write_mapping_csv(path, rows):
+    path.write_text("key_khi,gnd,ulan,viaf,wd\n" + "".join(f"{row}\n" for row in rows))
+    return str(path)
+
+
+def test_rerun_replaces_records_and_keeps_missing_ones(tmp_path):
+    store = str(tmp_path / "lookup.sqlite")
+    first = write_mapping_csv(tmp_path / "first.csv", [
+        "oai_kue_0700001.xml,gnd:118540238; gnd:20001,ulan:500001,,wd:Q42",
+        "oai_kue_0700002.xml,gnd:1002,,viaf:9002,http://www.wikidata.org/entity/Q2",
+    ])
+    second = write_mapping_csv(tmp_path / "second.csv", [
+        "oai_kue_0700001.xml,gnd:1001,,,wd:Q1",
+    ])
+
+    assert update_lookup_store(first, store) == 2
+    with AuthorityLookup(store) as lookup:
+        assert lookup.identifiers("oai_kue_0700001.xml") == {
+            'gnd': ['118540238', '20001'], 'ulan': ['500001'], 'wd': ['Q42']}
+        assert lookup.find_records('wd', 'Q2') == ["oai_kue_0700002.xml"]
+
+    assert update_lookup_store(second, store) == 1
+    with AuthorityLookup(store) as lookup:
+        # The record of the second csv file has only its new identifiers...
+        assert lookup.identifiers("oai_kue_0700001.xml") == {'gnd': ['1001'], 'wd': ['Q1']}
+        assert lookup.find_records('gnd', '118540238') == []
+        assert lookup.find_records('wd', 'Q42') == []
+        # ...and the record missing from it is kept
+        assert lookup.identifiers("oai_kue_0700002.xml") == {'gnd': ['1002'], 'viaf': ['9002'], 'wd': ['Q2']}
+        assert lookup.find_records('key_khi', "oai_kue_0700002.xml") == ["oai_kue_0700002.xml"]
+
+
+def test_lookups_accept_prefixed_values_and_wikidata_uris(tmp_path):
+    store = str(tmp_path / "lookup.sqlite")
+    mapping_csv = write_mapping_csv(tmp_path / "mapping.csv", [
+        "oai_kue_0700001.xml,gnd:1001,,,wd:Q1",
+        "oai_kue_0700002.xml,gnd:1001,,,http://www.wikidata.org/entity/Q1",
+    ])
+    update_lookup_store(mapping_csv, store)
+
+    records = ["oai_kue_0700001.xml", "oai_kue_0700002.xml"]
+    with AuthorityLookup(store) as lookup:
+        for value in ('Q1', 'wd:Q1', 'http://www.wikidata.org/entity/Q1', 'http://www.wikidata.org/entity/Q1/'):
+            assert lookup.find_records('wd', value) == records
+        assert lookup.find_records('gnd', 'gnd:1001') == records
+        assert lookup.find_records('gnd', ' 1001 ') == records
+        assert lookup.lookup('gnd', '1001') == {record: {'gnd': ['1001'], 'wd': ['Q1']} for record in records}
+
+
+def test_missing_store(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        AuthorityLookup(str(tmp_path / "missing.sqlite"))
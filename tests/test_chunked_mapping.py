@@ -0,0 +1,128 @@
+'''
+Checks the chunked mode of the mapping script: it must produce the same csv and XML files as the in-memory mode
+and keep the peak resident memory of the whole run under --memory-limit-mb on a synthetic multi-million-record input.
+Each run happens in a subprocess, so that its peak memory is not mixed up with the one of pytest.
+The memory limit check takes a few minutes and only runs with KHI_TEST_LARGE=1;
+the number of synthetic records can be changed with KHI_TEST_RECORDS.
+'''
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'authority-file-mapping')
+RECORDS = int(os.environ.get('KHI_TEST_RECORDS', 2000000))
+MEMORY_LIMIT_MB = 250
+XML_RECORDS = 300
+
+
+def write_synthetic_input(path, records):
+    '''
+    Writes extracted authority data as extract_authority_data does: one record per line with a GND, ULAN
+    or VIAF identifier, a second GND for every fifth record and an unmatched value for every hundredth one.
+    As extract_authority_data appends to the file on every run, records can appear more than once: the second record
+    first appears on a line with only an unmatched value, and one record never gets an identifier at all.
+    '''
+    with open(path, 'w') as f_out:
+        f_out.write(f"oai_kue_07{1:07d}.xml,unknown\n")
+        f_out.write("oai_kue_07_no_identifiers.xml,unknown\n")
+        for i in range(records):
+            identifiers = [f"{('GND', 'ULAN', 'VIAF')[i % 3]}{i}"]
+            if i % 5 == 0:
+                identifiers.append(f"GND{i + 1}")
+            if i % 100 == 0:
+                identifiers.append("unknown")
+            f_out.write(f"oai_kue_07{i:07d}.xml,{', '.join(identifiers)}\n")
+
+
+def write_synthetic_xml(folder_path, records):
+    '''
+    Writes the XML files of the first records with an empty <a30gn> element, which the mapping fills in.
+    '''
+    os.mkdir(folder_path)
+    for i in range(records):
+        with open(os.path.join(folder_path, f"oai_kue_07{i:07d}.xml"), 'w') as f_out:
+            f_out.write('<?xml version="1.0"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><record>'
+                        '<a30gn /></record></OAI-PMH>')
+
+
+def fake_execute_sparql_query(endpoint, query):
+    '''
+    Stand-in for execute_sparql_query: identifier n belongs to the Wikidata entity Qn, whose GND, ULAN and VIAF are n,
+    if n is a multiple of 4; other identifiers are not on Wikidata.
+    '''
+    prefix, values = re.search(r'VALUES \?(\w+) \{(.*?)\}', query, re.S).groups()
+    bindings = []
+    if prefix == 'wd':
+        for uri in re.findall(r'<([^>]+)>', values):
+            number = uri.rsplit('Q', 1)[-1]
+            bindings.append({'wd': {'value': uri}, 'gnd': {'value': number},
+                             'ulan': {'value': number}, 'viaf': {'value': number}})
+    else:
+        expand = '?wd_gnd' in query
+        for value in re.findall(r'"([^"]+)"', values):
+            if int(value) % 4:
+                continue
+            binding = {prefix: {'value': value}, 'wd': {'value': f"http://www.wikidata.org/entity/Q{value}"}}
+            if expand:
+                binding.update({'wd_gnd': {'value': value}, 'wd_ulan': {'value': value}, 'wd_viaf': {'value': value}})
+            bindings.append(binding)
+    return {'results': {'bindings': bindings}}
+
+
+def run_mapping(work_dir, records, chunk_size=None, memory_limit_mb=None):
+    '''
+    Runs the mapping script on synthetic records in a subprocess, chunked if chunk_size is given.
+    Returns the path of the csv file and the peak resident memory of the subprocess in MB.
+    '''
+    args = [sys.executable, os.path.abspath(__file__), str(work_dir), str(records), str(chunk_size), str(memory_limit_mb)]
+    # Records without an XML file are reported one line each, so the output goes to a file
+    with open(os.path.join(work_dir, 'mapping_output.txt'), 'w+') as f_output:
+        subprocess.run(args, stdout=f_output, check=True)
+        f_output.seek(0)
+        peak_rss_mb = float(re.search(r'peak_rss_mb=([\d.]+)', f_output.read()).group(1))
+    return os.path.join(work_dir, 'ordered_khi_a30gn_data.csv'), peak_rss_mb
+
+
+def test_chunked_mode_matches_in_memory_mode(tmp_path):
+    (tmp_path / 'memory').mkdir()
+    (tmp_path / 'chunked').mkdir()
+    memory_csv, _ = run_mapping(tmp_path / 'memory', 5000)
+    chunked_csv, _ = run_mapping(tmp_path / 'chunked', 5000, chunk_size=700)
+
+    with open(memory_csv, 'rb') as f_memory, open(chunked_csv, 'rb') as f_chunked:
+        assert f_memory.read() == f_chunked.read()
+    for xml_file in sorted(os.listdir(tmp_path / 'memory' / 'xml')):
+        memory_xml = (tmp_path / 'memory' / 'xml' / xml_file).read_bytes()
+        assert b'<a30gn />' not in memory_xml
+        assert (tmp_path / 'chunked' / 'xml' / xml_file).read_bytes() == memory_xml
+
+
+@pytest.mark.skipif(os.environ.get('KHI_TEST_LARGE') != '1', reason="set KHI_TEST_LARGE=1 to map millions of records")
+def test_chunked_mode_stays_under_memory_limit(tmp_path):
+    csv_path, peak_rss_mb = run_mapping(tmp_path, RECORDS, chunk_size=1000000, memory_limit_mb=MEMORY_LIMIT_MB)
+
+    assert peak_rss_mb < MEMORY_LIMIT_MB
+    with open(csv_path) as f_in:
+        assert sum(1 for _ in f_in) == RECORDS + 1
+
+
+if __name__ == '__main__':
+    # Subprocess of run_mapping: work_dir records chunk_size memory_limit_mb
+    import resource
+
+    work_dir, records, chunk_size, memory_limit_mb = sys.argv[1:]
+    os.chdir(work_dir)
+    write_synthetic_xml('xml', min(int(records), XML_RECORDS))
+    write_synthetic_input('khi_a30gn_data.txt', int(records))
+
+    sys.path.insert(0, SCRIPT_DIR)
+    import complete_authority_mapping_script as mapping
+
+    mapping.execute_sparql_query = fake_execute_sparql_query
+    mapping.extract_map_replace_xml('xml', None if chunk_size == 'None' else int(chunk_size),
+                                    None if memory_limit_mb == 'None' else int(memory_limit_mb), lookup_store=None)
+    print(f"peak_rss_mb={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}")
@@ -0,0 +1,63 @@
+'''
+Checks the export of the shared Metrics class: Prometheus textfile, JSON lines and profiling stats.
+'''
+import json
+
+from instrumentation import Metrics
+
+
+def test_prometheus_export(tmp_path):
+    metrics = Metrics("khi_test")
+    metrics.inc("records_total", 3, output="csv")
+    metrics.inc("records_total", 2, output="xml")
+    metrics.inc("bytes_written_total", 123456789)
+    metrics.observe_max("peak_rss_mb", 12.5)
+    metrics.observe_max("peak_rss_mb", 10.25)
+    metrics.observe("query_seconds", 0.2)
+    metrics.observe("query_seconds", 3)
+    with metrics.stage("extract"):
+        pass
+
+    path = tmp_path / "metrics.prom"
+    metrics.export(str(path))
+    lines = path.read_text().splitlines()
+
+    assert not (tmp_path / "metrics.prom.tmp").exists()
+    assert lines.count("# TYPE khi_test_records_total counter") == 1
+    assert 'khi_test_records_total{output="csv"} 3' in lines
+    assert 'khi_test_records_total{output="xml"} 2' in lines
+    assert "khi_test_bytes_written_total 123456789" in lines
+    assert "# TYPE khi_test_peak_rss_mb gauge" in lines
+    assert "khi_test_peak_rss_mb 12.5" in lines
+    assert any(line.startswith('khi_test_stage_seconds{stage="extract"} ') for line in lines)
+    assert 'khi_test_query_seconds_bucket{le="0.25"} 1' in lines
+    assert 'khi_test_query_seconds_bucket{le="+Inf"} 2' in lines
+    assert "khi_test_query_seconds_count 2" in lines
+
+
+def test_json_export_appends_one_line_per_run(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    for run in (1, 2):
+        metrics = Metrics("khi_test")
+        metrics.inc("records_total", run)
+        metrics.export(str(path))
+
+    runs = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [run["counters"][0]["value"] for run in runs] == [1, 2]
+
+
+def test_export_without_sampled_calls(tmp_path):
+    metrics = Metrics("khi_test")
+    metrics.enable_profiling(100)
+    double = metrics.profiled(lambda value: value * 2)
+    assert [double(value) for value in range(5)] == [0, 2, 4, 6, 8]
+
+    path = tmp_path / "metrics.prom"
+    metrics.export(str(path))
+    assert path.exists()
+    assert not (tmp_path / "metrics.prom.pstats").exists()
+
+    for value in range(100):
+        double(value)
+    metrics.export(str(path))
+    assert (tmp_path / "metrics.prom.pstats").exists()
@@ -0,0 +1,166 @@
+'''
+Checks the reuse of forward query results in the reverse mapping: on a fixture dataset mapped against a local
+SPARQL stand-in, reusing the results must halve the number of requests (6 without reuse, 3 with reuse) and give
+byte-identical csv file, conflicts log, unmatched log and XML files. The run without reuse sends the same
+queries as the mapping did before the reuse was added and serves as the baseline.
+'''
+import json
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import complete_authority_mapping_script as mapping
+
+
+OUTPUT_FILES = ('ordered_khi_a30gn_data.csv', 'wd_conflicts_log.txt', 'unmatched_authority_data.txt')
+
+# Wikidata entities Q1 to Q400 of the stand-in: Qn has GND 1000+n, a second GND for every seventh entity,
+# ULAN 5000+n for odd n and VIAF 9000+n unless n is a multiple of 3
+ENTITIES = {
+    f"http://www.wikidata.org/entity/Q{n}": {
+        'gnd': [f"{1000 + n}"] + ([f"{20000 + n}"] if n % 7 == 0 else []),
+        'ulan': [f"{5000 + n}"] if n % 2 else [],
+        'viaf': [f"{9000 + n}"] if n % 3 else [],
+    }
+    for n in range(1, 401)
+}
+
+
+def answer_query(query):
+    '''
+    Answers the queries of build_sparql_query from ENTITIES: one binding per combination of the selected values,
+    as the Wikidata endpoint does for OPTIONAL properties with several values.
+    '''
+    prefix, values = re.search(r'VALUES \?(\w+) \{(.*?)\}', query, re.S).groups()
+    variables = [var[1:] for var in re.search(r'SELECT (.*?) WHERE', query, re.S).group(1).split()]
+
+    if prefix == 'wd':
+        matches = [({'wd': uri}, ENTITIES[uri]) for uri in re.findall(r'<([^>]+)>', values) if uri in ENTITIES]
+    else:
+        matches = [({prefix: value, 'wd': uri}, properties)
+                   for value in re.findall(r'"([^"]+)"', values)
+                   for uri, properties in ENTITIES.items() if value in properties[prefix]]
+
+    rows = []
+    for row, properties in matches:
+        combinations = [row]
+        for name in ('gnd', 'ulan', 'viaf'):
+            for variable in (name, f"wd_{name}"):
+                if variable in variables and variable not in row and properties[name]:
+                    combinations = [dict(combination, **{variable: value})
+                                    for combination in combinations for value in properties[name]]
+        rows.extend(combinations)
+
+    bindings = [{key: {'type': 'uri' if key == 'wd' else 'literal', 'value': value} for key, value in row.items()}
+                for row in rows]
+    return {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+
+
+class SparqlStandIn(BaseHTTPRequestHandler):
+    '''
+    Local SPARQL endpoint answering from ENTITIES; counts the queries it receives.
+    '''
+    queries = []
+
+    def answer(self, params):
+        query = params.get('query', [''])[0]
+        self.queries.append(query)
+        body = json.dumps(answer_query(query)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.answer(parse_qs(self.rfile.read(length).decode()))
+
+    def log_message(self, *args):
+        pass
+
+
+def write_fixture(folder_path):
+    '''
+    Writes 300 KHI records with GNDs, ULANs and VIAFs of ENTITIES, unmatched values, a ULAN shared by several records
+    and, for every seventieth record, a ULAN of another entity, which is a Wikidata conflict.
+    '''
+    os.makedirs(folder_path, exist_ok=True)
+    for n in range(1, 301):
+        if n % 4 == 0:
+            identifiers = [f"GND{1000 + n}"]
+        elif n % 4 == 1:
+            identifiers = [f"ULAN{5000 + n}"]
+        elif n % 4 == 2:
+            identifiers = [f"VIAF{9000 + n}" if n % 3 else f"GND{1000 + n}"]
+        else:
+            identifiers = [f"GND{1000 + n}", "unknown"]
+        if n % 50 == 0:
+            identifiers.append("ULAN77777")
+        if n % 70 == 0:
+            identifiers.append(f"ULAN{5000 + n + 1}")
+        with open(os.path.join(folder_path, f"oai_kue_07{n:05d}.xml"), 'w') as f_out:
+            f_out.write('<?xml version="1.0"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><record>'
+                        f'<a30gn>{"; ".join(identifiers)}</a30gn></record></OAI-PMH>')
+
+
+@pytest.fixture
+def sparql_endpoint(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SparqlStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    SparqlStandIn.queries = []
+    monkeypatch.setattr(mapping, 'WD_SPARQL_ENDPOINT', f"http://127.0.0.1:{server.server_port}/sparql")
+    yield SparqlStandIn.queries
+    server.shutdown()
+    server.server_close()
+
+
+def run_mapping(work_dir, output_dir, reuse_results, queries):
+    '''
+    Maps a fresh copy of the fixture in work_dir and moves the outputs to output_dir.
+    Both runs use the same work_dir, so that the XML files are listed in the same order.
+    Returns the number of SPARQL requests sent.
+    '''
+    for name in ('xml', 'khi_a30gn_data.txt') + OUTPUT_FILES:
+        path = os.path.join(work_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    write_fixture(os.path.join(work_dir, 'xml'))
+
+    del queries[:]
+    mapping.extract_map_replace_xml('xml', reuse_results=reuse_results, lookup_store=None)
+    request_count = len(queries)
+
+    os.makedirs(output_dir)
+    for name in OUTPUT_FILES:
+        shutil.move(os.path.join(work_dir, name), output_dir)
+    shutil.copytree(os.path.join(work_dir, 'xml'), os.path.join(output_dir, 'xml'))
+    return request_count
+
+
+def test_query_reuse_halves_requests_with_identical_output(tmp_path, monkeypatch, sparql_endpoint):
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+
+    baseline_requests = run_mapping(str(work_dir), str(tmp_path / 'baseline'), False, sparql_endpoint)
+    reuse_requests = run_mapping(str(work_dir), str(tmp_path / 'reuse'), True, sparql_endpoint)
+
+    assert (baseline_requests, reuse_requests) == (6, 3)
+    assert all('?wd_gnd' in query for query in sparql_endpoint)
+
+    for name in OUTPUT_FILES + tuple(os.path.join('xml', xml_file) for xml_file in sorted(os.listdir(work_dir / 'xml'))):
+        baseline = (tmp_path / 'baseline' / name).read_bytes()
+        assert baseline, f"{name} is empty"
+        assert (tmp_path / 'reuse' / name).read_bytes() == baseline, f"{name} differs"